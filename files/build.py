@@ -9,6 +9,9 @@ This script differs in a few ways from the standard build:
   release candidate (with an added 'rc' at the end of the version) without modifying meta.yml.
 * Replace CONDA_PASSWORD in conda channel URLs on the fly (older conda versions failed to do this)
 * ensure there are non-empty directories linux-64, osx-64, noarch, and win-64 in the output.
+* If SKA_CLONE_CACHE is set, a mirror of skare3 is kept in that directory and reused across runs.
+  Concurrent runs sharing the cache are serialized with flock, which is not available on Windows,
+  so on Windows the cache must not be shared by concurrent runs.
 
 NOTE: Argument order seems to matter. Any argument unknown to this script is passed to ska_builder.
 It seems that unknown arguments must be consecutive, and known arguments must be consecutive.
@@ -17,21 +20,43 @@ import sys
 import os
 import subprocess
 import re
+import shlex
+import shutil
 import argparse
 import tempfile
 import pathlib
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+SKARE3_URL = 'https://github.com/sot/skare3.git'
+
+# matches "  version: <version>" and "  - ska3-<name> ==<version>" at the start of a line
+META_VERSION_RE = re.compile(
+    r'^[ \t]*(?:-[ \t]+)?'
+    r'(?:version[ \t]*:[ \t]*(?P<version>\S+)'
+    r'|(?P<name>ska3-\S+?)[ \t]*==[ \t]*(?P<pin>\S+))',
+    re.MULTILINE
+)
+
 
 def overwrite_skare3_version(current_version, new_version, pkg_path):
     """
     Replaces `current_version` by `new_version` in the meta.yaml file located at `pkg_path`.
 
-    This is not a general replacement. The version is replaced if:
+    This is not a general replacement. The version is replaced if the line starts with:
 
-      - the line matches the pattern "  version: <current_version>"
-      - the line matches the pattern "  <pkg_name> ==<current_version>"
+      - "  version: <current_version>"
+      - "  ska3-<name> ==<current_version>"
 
-    with possible whitespace before/after, or whitespace around the colon or equality operator.
+    with possible indentation and an optional list dash ("- ") before the key or name, and
+    possible whitespace around the colon or equality operator. Only the captured value is
+    replaced. Other keys ending in "version" (e.g. "min_version:"), pins of packages not named
+    "ska3-*", and any other occurrence of the version in the line (e.g. in a trailing comment)
+    are left unchanged.
 
     Note that this function would not replace the version string if the "version" tag and the value
     are not in the same line, even though this is correct yaml syntax.
@@ -42,25 +67,69 @@ def overwrite_skare3_version(current_version, new_version, pkg_path):
     :return:
     """
     meta_file = pkg_path / 'meta.yaml'
-    with open(meta_file) as fh:
-        lines = fh.readlines()
-    for i, line in enumerate(lines):
-        m = re.search(r'(\s+)?version(\s+)?:(\s+)?(?P<version>(\S+)+)', line)
-        if m:
-            version = m.groupdict()['version']
-            if version == str(current_version):
-                print(f'    - version: {current_version} -> {new_version}')
-                lines[i] = line.replace(current_version, new_version)
-        m = re.search(r'(\s+)?(?P<name>\S+)(\s+)?==(\s+)?(?P<version>(\S+)+)', line)
-        if m:
-            info = m.groupdict()
-            if re.match(r'ska3-\S+$', info['name']) and info['version'] == current_version:
-                print(f'    - {info["name"]} dependency: {current_version} -> {new_version}')
-                lines[i] = line.replace(current_version, new_version)
-
-    with open(meta_file, 'w') as f:
-        for line in lines:
-            f.write(line)
+    current_version = str(current_version)
+
+    def replace(m):
+        if m['version'] == current_version:
+            print(f'    - version: {current_version} -> {new_version}')
+        elif m['pin'] == current_version:
+            print(f'    - {m["name"]} dependency: {current_version} -> {new_version}')
+        else:
+            return m[0]
+        return m[0].replace(current_version, new_version)
+
+    meta_file.write_text(META_VERSION_RE.sub(replace, meta_file.read_text()))
+
+
+def clone_skare3(branch, skare3_path):
+    """
+    Clones skare3 at `branch` into `skare3_path`.
+
+    If the SKA_CLONE_CACHE environment variable is set, a mirror of skare3 is kept in that
+    directory. The mirror is updated with `git fetch` and the clone shares its objects, so only
+    new commits are downloaded. Otherwise, if `git ls-remote` finds `branch` as a branch or tag,
+    this does a shallow clone of it. Anything else (e.g. a commit sha) gets a full clone.
+
+    :param branch: str
+        a branch, tag or commit.
+    :param skare3_path: pathlib.Path
+    :return:
+    """
+    cache_dir = os.environ.get('SKA_CLONE_CACHE')
+    if not cache_dir:
+        refs = subprocess.run(['git', 'ls-remote', SKARE3_URL,
+                               f'refs/heads/{branch}', f'refs/tags/{branch}'],
+                              capture_output=True, text=True)
+        if refs.returncode == 0 and refs.stdout.strip():
+            subprocess.check_call(['git', 'clone', '--depth=1', '--single-branch',
+                                   '--branch', branch, SKARE3_URL, str(skare3_path)])
+        else:
+            subprocess.check_call(['git', 'clone', '--no-checkout', SKARE3_URL, str(skare3_path)])
+            subprocess.check_call(['git', 'checkout', branch], cwd=skare3_path)
+        return
+
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_path = cache_dir / 'skare3.git'
+    # the lock is released when the file is closed
+    with open(cache_dir / 'skare3.lock', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if cache_path.exists():
+            subprocess.check_call(['git', 'fetch', '--prune', '--tags'], cwd=cache_path)
+        else:
+            # clone under a temporary name, so an interrupted clone is never taken as the mirror
+            tmp_path = cache_dir / 'skare3.git.tmp'
+            if tmp_path.exists():
+                shutil.rmtree(tmp_path)
+            subprocess.check_call(['git', 'clone', '--mirror', SKARE3_URL, str(tmp_path)])
+            # clones share the mirror's objects, so gc may repack but must never prune them
+            for key in ['gc.pruneExpire', 'gc.reflogExpireUnreachable']:
+                subprocess.check_call(['git', 'config', key, 'never'], cwd=tmp_path)
+            tmp_path.replace(cache_path)
+        subprocess.check_call(['git', 'clone', '--shared', '--no-checkout',
+                               str(cache_path), str(skare3_path)])
+        subprocess.check_call(['git', 'checkout', branch], cwd=skare3_path)
 
 
 """
@@ -113,50 +182,48 @@ def main():
     print(f"Building {package}")
 
     # setup condarc, because conda does not seem to replace the env variables
-    if 'CONDA_PASSWORD' in os.environ:
+    conda_password = os.environ.get('CONDA_PASSWORD')
+    if conda_password is not None:
         condarc = pathlib.Path.home() / '.condarc'
         condarc_in = condarc.with_suffix('.in')
         condarc.replace(condarc_in)
-        with open(condarc_in) as condarc_in, open(condarc, 'w') as condarc:
-            for line in condarc_in.readlines():
-                condarc.write(line.replace('${CONDA_PASSWORD}', os.environ['CONDA_PASSWORD']))
+        condarc.write_text(condarc_in.read_text().replace('${CONDA_PASSWORD}', conda_password))
     else:
         print('Conda password needs to be given as environmental variable CONDA_PASSWORD')
         sys.exit(100)
 
     tmp_dir = pathlib.Path('tmp')
-    if not tmp_dir.exists():
-        tmp_dir.mkdir()
+    tmp_dir.mkdir(exist_ok=True)
     with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_dir:
         tmp_dir = pathlib.Path(tmp_dir)
         skare3_path = tmp_dir / 'skare3'
         print(f'skare3_path: {skare3_path}')
 
         # fetch skare3
-        subprocess.check_call(['git', 'clone',
-                               'https://github.com/sot/skare3.git'],
-                              cwd=skare3_path.parent)
-        subprocess.check_call(['git', 'checkout', args.skare3_branch], cwd=skare3_path)
+        clone_skare3(args.skare3_branch, skare3_path)
 
         # do the actual building
-        cmd = ['python', 'ska_builder.py', '--github-https', '--force'] + unknown_args + [package]
+        cmd = (
+            [sys.executable, 'ska_builder.py', '--github-https', '--force']
+            + unknown_args
+            + [package]
+        )
         # overwrite version
         if args.ska3_overwrite_version:
             cmd += ['--ska3-overwrite-version', args.ska3_overwrite_version]
-        print(' '.join(cmd))
+        print(shlex.join(cmd))
         subprocess.check_call(cmd, cwd=skare3_path)
         print('SKARE3 conda process finished')
 
         # move resulting files to work dir
         build_dir = pathlib.Path('builds')
-        if not build_dir.exists():
-            build_dir.mkdir()
+        build_dir.mkdir(exist_ok=True)
+        skare3_build_dir = skare3_path / 'builds'
         for d in ['linux-64', 'osx-64', 'noarch', 'win-64']:
             print(d)
-            d_from = skare3_path / 'builds' / d
+            d_from = skare3_build_dir / d
             d_to = build_dir / d
-            if not d_to.exists():
-                d_to.mkdir()
+            d_to.mkdir(exist_ok=True)
             # I do this to make sure the directory is not empty
             with open(d_to / '.ensure-non-empty-dir', 'w'):
                 pass